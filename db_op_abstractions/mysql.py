@@ -3,8 +3,13 @@ This module represents a connection to MySQL with some higher level functions th
 """
 
 import pymysql as MySQLdb
+import pymysql.cursors #loads the submodule used below as MySQLdb.cursors (MySQLdb is the pymysql alias above)
 from pymysql.converters import escape_string
 
+from db_op_abstractions import get_module_logger
+
+logger = get_module_logger(__name__)
+
 class MysqlConnCM(object):
     """Context manager inheriting from MysqlConn"""
     def __init__(self, databaseName, usr, password, mysql_host_ip, prt):
@@ -12,7 +17,7 @@ class MysqlConnCM(object):
             self.myDB = MySQLdb.connect(host=mysql_host_ip, port=int(prt), user=usr, passwd=password.replace("\"",""), db=databaseName, charset='utf8mb4')   
             self.conn = self.myDB.cursor() 
         except MySQLdb.Error as msg:
-            print("MYSQL ERROR!: {0}".format(msg))
+            logger.error("MYSQL ERROR!: %s", msg)
     
     def __enter__(self):
         return self
@@ -29,20 +34,23 @@ class MysqlConnCM(object):
         """closes mysql connection"""
         self.conn.close() 
         
-    def select_generator(self, stmt):
+    def select_generator(self, stmt, stream=False):
         """execute a select query and return results as a generator
         
+        if stream is True, rows are read from the server one at a time with an unbuffered SSCursor instead of
+        the whole result being downloaded first. The connection can not run other queries until the generator is exhausted or closed.
+        
         TODO: This should take args, and then call self.conn.execute(stmt, args), stmt should have %s
         """
-        try:   
-            data = []    
-            self.conn.execute(stmt)
-            """TODO: currently defeats the purpose of a generator, fix this to fetch_one"""
-            data = self.conn.fetchall() 
-            for row in data:
-                yield row
+        cursor = self.myDB.cursor(MySQLdb.cursors.SSCursor) if stream else self.conn
+        try:
+            cursor.execute(stmt)
+            yield from cursor
         except MySQLdb.Error as msg:
-            print("MYSQL QUERY ERROR!: {0}".format(msg))
+            logger.error("MYSQL QUERY ERROR!: %s", msg)
+        finally:
+            if stream:
+                cursor.close()
                 
     def exec_query_list(self, Q):
         """execute a bunch of sql queries, commits at end. An error on query i does not halt query i+1
@@ -57,7 +65,7 @@ class MysqlConnCM(object):
             try: 
                 self.conn.execute(q)
             except MySQLdb.Error as msg:
-                print("{1} MYSQL QUERY ERROR!: {0}".format(msg, q))
+                logger.error("%s MYSQL QUERY ERROR!: %s", q, msg)
         self.myDB.commit()
     
     def bulk_insert(self, rows, insert_clause, update_clause):
@@ -67,15 +75,19 @@ class MysqlConnCM(object):
         """
         #http://dev.mysql.com/doc/refman/5.0/en/insert-on-duplicate.html
         #bulk insert limit is 50000
-        insert_queue = []  
-        insert_vals = "" 
-        count_this_run = 0 
-        total_count = 0
-        for i in range(0, len(rows)): 
-            total_count += 1
-            insert_vals += "(" + ",".join(["'{0}'".format(k) for k in [self.escape(j) if type(j) == str else j for j in rows[i]]]) + "),"                                                                                                                               
-            if total_count % 10000 == 0 or total_count == len(rows): #start a new bulk insert every 5K rows
-                insert_queue.append(insert_clause + " VALUES " + insert_vals[0:-1].replace("'None'","NULL") + " " + update_clause + ";") #REPLACE Python Nones with proper mysql NULLs
-                insert_vals = "" #reset values
-        self.exec_query_list(insert_queue)        
+        #the driver escapes each value and binds Python Nones as proper mysql NULLs.
+        #strings are stripped and empty strings stored as NULL, as self.escape always did for this function
+        params = "(" + ",".join(["%s"] * len(rows[0])) + ")" if rows else ""
+        mogrify = self.conn.mogrify #local name skips the attribute lookups per row
+        #the constant parts of every statement are built once, not per 10K rows
+        prefix = insert_clause + " VALUES "
+        suffix = " " + update_clause + ";"
+        insert_queue = []
+        parts = []
+        for total_count, row in enumerate(rows, 1):
+            parts.append(mogrify(params, [(j.strip() if j else None) if isinstance(j, str) else j for j in row]))
+            if total_count % 10000 == 0 or total_count == len(rows): #start a new bulk insert every 10K rows
+                insert_queue.append(prefix + ",".join(parts) + suffix)
+                parts = [] #reset values
+        self.exec_query_list(insert_queue)
 
@@ -2,10 +2,19 @@
 
 from __future__ import division
 import sys, traceback
+import csv
+import io
+import re
+import threading
+import uuid
 import psycopg2
 import psycopg2.errorcodes
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import psycopg2.pool
+from psycopg2.extras import execute_batch, execute_values
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_INERROR, quote_ident
 from math import ceil
+from itertools import islice
+from functools import lru_cache
 from contexttimer import Timer
 
 from db_op_abstractions import get_module_logger
@@ -16,6 +25,81 @@ logger = get_module_logger(__name__)
 see: https://wiki.postgresql.org/wiki/Using_psycopg2_with_PostgreSQL
 """
 
+#connection pools shared by all PGConnCMs created with pool_maxconn, keyed on the connection parameters
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(minconn, maxconn, **connect_kwargs):
+    """returns the shared pool for connect_kwargs, creating it on first use"""
+    key = tuple(sorted(connect_kwargs.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        return _pools[key]
+
+def close_all_pools():
+    """closes every connection held by the shared pools, e.g., at process shutdown"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+@lru_cache(maxsize=32)
+def _row_template(num_fields):
+    """execute_values row template for num_fields columns, e.g. b"(%s,%s)"; built once per column count"""
+    return ("(" + ",".join(["%s"] * num_fields) + ")").encode()
+
+def _prepared_placeholders(stmt):
+    """
+    Rewrites a psycopg2 style statement to PREPARE's positional form: each %s becomes $1, $2..., and %% becomes %.
+    As with cursor.execute, a literal % must be written %% (this includes '%s' inside string literals).
+    Raises ValueError on any other placeholder, e.g. %(name)s.
+
+    Returns (prepared_stmt, num_params)
+    """
+    num_params = 0
+    def repl(m):
+        nonlocal num_params
+        if m.group(1) == "%":
+            return "%"
+        if m.group(1) == "s":
+            num_params += 1
+            return "${0}".format(num_params)
+        raise ValueError("only %s placeholders (and %% for a literal %) are supported, got {0!r}".format(m.group(0)))
+    return re.sub(r"%(.?)", repl, stmt, flags=re.DOTALL), num_params
+
+class _CSVStream(object):
+    """
+    Read only file-like object over an iterable of tuples. Rows are formatted as csv lazily, as psycopg2 reads,
+    so only about one read() worth of csv is ever held in memory. Nones are written as \\N.
+    """
+    def __init__(self, rows):
+        self.rows_read = 0
+        self._rows = iter(rows)
+        self._buf = ""
+        self._line = io.StringIO()
+        self._writer = csv.writer(self._line, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+
+    def _next_line(self):
+        row = next(self._rows)
+        self._writer.writerow(["\\N" if v is None else v for v in row])
+        line = self._line.getvalue()
+        self._line.seek(0)
+        self._line.truncate()
+        self.rows_read += 1
+        return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += self._next_line()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
 class PGConnCM(object):
     """
     Connection to pg as a context manager for a one time operation (use above for continuous connection)
@@ -29,13 +113,37 @@ class PGConnCM(object):
         return self
 
     def __exit__(self, *args):
-        self.connection.close()
+        if self._pool is None:
+            self.connection.close()
+        else:
+            #hand the connection back without leaking an open (or aborted) transaction to the next user;
+            #if that fails (e.g., the server dropped it) the connection is closed, but always returned so its slot is freed
+            close = True
+            try:
+                if not self.connection.closed:
+                    self.cursor.close()
+                    self.connection.rollback()
+                    close = False
+            except Exception as e:
+                logger.error("Discarding pooled connection, rollback failed: {0}".format(e))
+            finally:
+                self._pool.putconn(self.connection, close=close)
 
-    def __init__(self, database, user, password, host, port, create_database_on_init = False):
+    def __init__(self, database, user, password, host, port, create_database_on_init = False, pool_maxconn = None, pool_minconn = None):
         """
         if create_database_on_init is True, then this connects to the Postgres database by default
         and tries to create the database `database`. The passed in User must have perms to do this
         This function keeps going if the database already exists.
+
+        if pool_maxconn is set, the connection is borrowed from a process wide pool (of at most pool_maxconn
+        connections) shared with every PGConnCM using the same connection parameters, and is returned to it on exit,
+        saving the connect handshake on each operation. Anything not committed before exit is rolled back.
+        The pool does not wait: if pool_maxconn connections are already checked out, this raises psycopg2.pool.PoolError.
+        The pool keeps at most pool_minconn idle connections (default: pool_maxconn); connections returned beyond that
+        are closed, so concurrent users above pool_minconn pay the connect handshake again. The pool opens
+        pool_minconn connections when it is created.
+        The pool is sized by the first PGConnCM created for a given set of connection parameters; a different
+        pool_maxconn/pool_minconn passed later for the same parameters is ignored.
         """
         if create_database_on_init:
             try:
@@ -50,45 +158,146 @@ class PGConnCM(object):
             except psycopg2.ProgrammingError:
                 pass #database already exists, keep going
 
-        self.connection = psycopg2.connect(database=database, user=user, password=password, port=int(port), host=host)
+        connect_kwargs = dict(database=database, user=user, password=password, port=int(port), host=host)
+        if pool_maxconn is None:
+            self._pool = None
+            self.connection = psycopg2.connect(**connect_kwargs)
+        else:
+            self._pool = _get_pool(pool_maxconn if pool_minconn is None else pool_minconn, pool_maxconn, **connect_kwargs)
+            self.connection = self._pool.getconn()
         self.cursor = self.connection.cursor()
 
-    def select_generator(self,stmt, tup = ()):
+    def select_generator(self,stmt, tup = (), itersize = 2000):
         """execute a select query and return results as a generator
         tup: a safe pg statement is of the form
                cur.execute("SELECT * FROM data WHERE id = %s;", (ids,))
             tup is (ids,)
+
+        Rows are streamed from a server side (named) cursor, itersize rows per round trip, so only
+        that many rows are held in memory at once. The cursor is declared WITH HOLD, so it stays valid if the
+        connection commits while iterating (e.g., bulk_insert per row read); on such a commit the server
+        materializes the rest of the result.
+
+        An error running the query is logged and yields nothing; an error after rows have been yielded is raised,
+        so a cut short stream is never mistaken for the end of the results.
         """
-        data = []
+        cursor = self.connection.cursor(name="select_generator_{0}".format(uuid.uuid4().hex), withhold=True)
+        cursor.itersize = itersize
+        row_yielded = False
         try:
-            self.cursor.execute(stmt, tup)
-            #change if RAM not plentiful..currently defeats the purpose of a generator
-            data = self.cursor.fetchall()
-            for row in data:
+            cursor.execute(stmt, tup)
+            for row in cursor:
+                row_yielded = True
                 yield row
         except Exception as msg:
+            if row_yielded:
+                raise
             logger.error("psycopg2 SELECT ERROR!: {0}".format(msg))
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error as msg:
+                logger.error("psycopg2 failed to close select_generator cursor: {0}".format(msg))
 
-    def exec_query_list(self, Q):
+    def exec_query_list(self, Q, commit_every=None):
         """
-        execute a bunch of sql queries, commiting after each one. An error on query i does not halt query i+1
+        execute a bunch of sql queries. An error on query i does not halt query i+1
 
         Q is a list of fully formed statements e.g., "CREATE TABLE ....;"
+
+        Each query runs inside a savepoint, so a failing query is rolled back on its own without losing the others.
+        Commits happen after every commit_every successful queries, and once at the end (the default is only at the end).
+        This trades one commit (WAL flush) per query for an extra round trip per query: SAVEPOINT, the query
+        and RELEASE, instead of the query and a commit.
+
+        If the connection is already in an aborted transaction (e.g., a swallowed error), it is rolled back first.
         """
+        if self.connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+            logger.error("Connection is in an aborted transaction, rolling back before executing")
+            self.connection.rollback()
         succ_exec = 0
         for q in Q:
+            self.cursor.execute("SAVEPOINT exec_query_list")
             try:
                 self.cursor.execute(q)
-                self.connection.commit()
-                succ_exec+=1
+                self.cursor.execute("RELEASE SAVEPOINT exec_query_list")
             except psycopg2.ProgrammingError as msg:
                 logger.error("Failed pg execution: {0}, error: {1}".format(q,msg))
-                self.connection.rollback()
+                self.cursor.execute("ROLLBACK TO SAVEPOINT exec_query_list")
+                self.cursor.execute("RELEASE SAVEPOINT exec_query_list") #rolling back keeps the savepoint; release it so they do not nest
             except Exception as msg:
                 logger.error("Unknown error on: {0}, error: {1}".format(q,msg))
-                self.connection.rollback()
+                self.cursor.execute("ROLLBACK TO SAVEPOINT exec_query_list")
+                self.cursor.execute("RELEASE SAVEPOINT exec_query_list")
+            else:
+                succ_exec+=1
+                if commit_every and succ_exec % commit_every == 0:
+                    self.connection.commit()
+        self.connection.commit()
         logger.info("Sucessfuly executed {0} out of {1} operations".format(succ_exec, len(Q)))
 
+    def exec_query_list_pipelined(self, Q):
+        """
+        Same contract as exec_query_list, but sends all of Q to the server in one round trip instead of one per query.
+
+        The whole of Q runs as a single transaction. If any query fails, that transaction is rolled back and Q is
+        re-run through exec_query_list, so an error on query i still does not halt query i+1 and is logged per query.
+        """
+        if not Q:
+            return
+        try:
+            self.cursor.execute("\n".join(q if q.rstrip().endswith(";") else q + ";" for q in Q))
+            self.connection.commit()
+            logger.info("Sucessfuly executed {0} out of {0} operations".format(len(Q)))
+        except Exception as msg:
+            logger.info("Pipelined execution failed ({0}), retrying one query at a time".format(msg))
+            self.connection.rollback()
+            self.exec_query_list(Q)
+
+    def exec_query_many(self, stmt, params_list, page_size=500):
+        """
+        execute the same statement once per parameter tuple, commiting at end
+
+        stmt uses %s placeholders, e.g., "UPDATE t SET c = %s WHERE id = %s", and params_list is an iterable
+        (list, generator...) of tuples to bind to them. A literal % is written %%; named %(name)s placeholders are not supported (ValueError).
+        stmt is PREPAREd once so the server plans it a single time, and the EXECUTEs are sent page_size at a time.
+
+        Upon an exception, everything is rolled back and the exception is re-raised.
+
+        Returns the number of statements executed
+        """
+        prepared_stmt, num_params = _prepared_placeholders(stmt)
+        prepared = "exec_query_many_{0}".format(uuid.uuid4().hex)
+        execute_stmt = "EXECUTE {0}".format(prepared) + ("({0})".format(",".join(["%s"] * num_params)) if num_params else "")
+        try:
+            self.cursor.execute("PREPARE {0} AS {1}".format(prepared, prepared_stmt))
+        except Exception as e:
+            logger.error("Failed pg PREPARE: {0}, error: {1}".format(stmt, e))
+            self.connection.rollback()
+            raise e
+        num_executed = 0
+        def counted(params):
+            nonlocal num_executed
+            for p in params:
+                num_executed += 1
+                yield p
+        try:
+            execute_batch(self.cursor, execute_stmt, counted(params_list), page_size=page_size)
+            self.connection.commit()
+            return num_executed
+        except Exception as e:
+            logger.error("Failed pg execution: {0}, error: {1}".format(stmt, e))
+            self.connection.rollback()
+            raise e
+        finally:
+            #prepared statements belong to the session, not the transaction, so they outlive the rollback.
+            #a failure here (e.g., a dead connection) is only logged so it does not mask the original exception
+            try:
+                self.cursor.execute("DEALLOCATE {0}".format(prepared))
+                self.connection.commit()
+            except Exception as e:
+                logger.error("Failed pg DEALLOCATE {0}, error: {1}".format(prepared, e))
+
     def exec_query_list_rollback_on_error(self, Q):
         for q in Q:
             try:
@@ -104,27 +313,39 @@ class PGConnCM(object):
         self.connection.commit() #commit only if no errors
         logger.info("Sucessfuly executed all operations")
 
-    def bulk_insert_chunks(self, table_name, values, chunk_size=1000):
+    def bulk_insert_chunks(self, table_name, values, chunk_size=1000, copy_threshold=None, chunks_per_commit=50):
         """
-        Bulk insert via batches., commiting after each batch. If any of the batches fails, insertions continue by
-        attempting the next batch. Unexpected failures are only logged.
+        Bulk insert via batches of chunk_size*chunks_per_commit records (50,000 by default), commiting after each batch.
+        If any of the batches fails, that whole batch is rolled back and insertions continue by attempting the next batch.
+        Unexpected failures are only logged.
+
+        Within a batch, psycopg2 sends each chunk of chunk_size records as one INSERT. Pass chunks_per_commit=1 to
+        commit (and fail) every chunk on its own.
+        If copy_threshold is set, batches larger than copy_threshold records are loaded with bulk_copy (COPY) instead
+        of an INSERT. Only do this for scalar values, see bulk_copy.
+
+        values may be any iterable of tuples (e.g., a generator reading from a file); it is consumed one chunk at a time.
 
         Returns the total number of records sucessfully inserted.
         """
-        logger.info("Insert: {0}records, {1}records/chunk".format(len(values), chunk_size))
+        logger.info("Insert: {0}records, {1}records/chunk".format(len(values) if hasattr(values, "__len__") else "?", chunk_size))
 
         def chunks(src, chunk_size):
-            chunk_count = int(len(src)/chunk_size)
-            chunk_count = 1 if chunk_count == 0 else chunk_count
-            for i in range(0, chunk_count):
-                yield src[i*chunk_size:(i+1)*chunk_size] \
-                    if chunk_count-1 > i else src[i*chunk_size:]
+            it = iter(src)
+            while True:
+                chunk = list(islice(it, chunk_size))
+                if not chunk:
+                    return
+                yield chunk
 
         with Timer() as ct:
             total_records = 0
-            for cindex, chunk in enumerate(chunks(values, chunk_size)):
+            for cindex, chunk in enumerate(chunks(values, chunk_size*chunks_per_commit)):
                 try:
-                    num_records = self.bulk_insert(table_name, chunk)
+                    if copy_threshold is not None and len(chunk) > copy_threshold:
+                        num_records = self.bulk_copy(table_name, chunk)
+                    else:
+                        num_records = self.bulk_insert(table_name, chunk, page_size=chunk_size)
                     total_records += num_records
                 except Exception as e:
                     logger.error("Chunk {0} has failed due to {1}".format(cindex, e))
@@ -132,11 +353,12 @@ class PGConnCM(object):
 
         return total_records
 
-    def bulk_insert(self, table_name, values):
+    def bulk_insert(self, table_name, values, page_size=None):
         """
         Bulk insert
 
         values is a list of tuples to insert
+        page_size is the max number of records sent per INSERT statement; defaults to all of values in one statement
 
         Upon an exception, the entire batch fails and the progress is rolled back.
         If you want to execute smaller batches where successive batches are tried
@@ -144,31 +366,46 @@ class PGConnCM(object):
 
         Returns the number of records inserted, or re-raises the exception after a rollback
         """
-
-        num_fields = len(values[0])
-        params = ','.join(['%s' for i in range(0, num_fields)])
-        params = "({0})".format(params)
         try:
-               # In python3.4 version of psycopg2, mogrify returns a byte string.
-               # while 2.7 version returns a string.
-               # Thus, always write the values into byte string first then convert
-               # to unicode
-               str_values = b','.join([self.cursor.mogrify(params, x) for x in values])
-               str_values = str_values.decode('utf-8')
-               query = u"INSERT INTO {0} VALUES {1}".format(table_name, str_values)
-               self.cursor.execute(query)
-               self.connection.commit()
-               return len(values)
-        except psycopg2.ProgrammingError as e:
+            # execute_values renders the rows in C and sends them page_size at a time
+            execute_values(self.cursor, "INSERT INTO {0} VALUES %s".format(table_name), values,
+                           template=_row_template(len(values[0])) if values else None, page_size=page_size or len(values))
+            self.connection.commit()
+            return len(values)
+        except (psycopg2.ProgrammingError, psycopg2.IntegrityError) as e:
             logger.error("Failed pg bulk_insert: error: {0}".format(e))
             self.connection.rollback()
             raise e
-        except psycopg2.IntegrityError as e:
-            logger.error("Failed pg bulk_insert: error: {0}".format(e))
+        except Exception as e:
+            logger.error("Unknown error: {0}".format(e))
             self.connection.rollback()
             raise e
+
+    def bulk_copy(self, table_name, values, columns=None):
+        """
+        Bulk load using COPY ... FROM STDIN, which skips the SQL parser and is much faster than INSERT for large loads
+
+        values is an iterable of tuples to insert. It is streamed to the server as it is consumed, so it can be
+        a generator over more rows than fit in memory.
+        columns is an optional list of column names the tuples map to; defaults to all columns of the table
+
+        Unlike bulk_insert, values are not adapted by psycopg2: each one is written with str(), so only scalars whose
+        text form is valid Postgres input (str, numbers, bools, dates, Decimal, UUID...) can be loaded. bytes, lists,
+        dicts etc. would be stored as their Python repr; use bulk_insert for those.
+        Python Nones are sent as \\N, so a string value of exactly \\N will also be loaded as NULL.
+
+        Upon an exception, the entire batch fails and the progress is rolled back.
+
+        Returns the number of records inserted, or re-raises the exception after a rollback
+        """
+        stream = _CSVStream(values)
+        cols = " ({0})".format(",".join(columns)) if columns else ""
+        try:
+            self.cursor.copy_expert("COPY {0}{1} FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table_name, cols), stream)
+            self.connection.commit()
+            return stream.rows_read
         except Exception as e:
-            logger.error("Unknown error: {0}".format(e))
+            logger.error("Failed pg bulk_copy: error: {0}".format(e))
             self.connection.rollback()
             raise e
 
@@ -186,21 +423,35 @@ class PGConnCM(object):
         self.cursor.execute(stmt)
         return [i[0] for i in self.cursor.fetchall()]
 
-    def row_count_all_tables(self):
+    def row_count_all_tables(self, approximate=False):
         """
         There is no way to easily get the EXACT row count of all tables in a database:
         http://stackoverflow.com/questions/2596670/how-do-you-find-the-row-count-for-all-your-tables-in-postgres
 
-        If you can't rely on one of the estimates there, this function computes it exactly.
+        If you can't rely on one of the estimates there, this function computes it exactly, counting all tables in a single query.
+        If approximate is True, the planner's estimate (pg_class.reltuples, as of the last VACUUM/ANALYZE) is returned instead,
+        which is nearly free regardless of table size. Tables that were never vacuumed or analyzed report 0, as do
+        partitioned tables unless the parent itself has been analyzed.
 
         Returns a list of tuples [(table_name, row_count)]
         """
+        if approximate:
+            stmt = """
+            SELECT c.relname, GREATEST(c.reltuples, 0)::bigint
+              FROM pg_class c
+              JOIN pg_namespace n ON n.oid = c.relnamespace
+               WHERE n.nspname = 'public'
+                  AND c.relkind IN ('r', 'p');
+            """
+            self.cursor.execute(stmt)
+            return [(t, int(n)) for t, n in self.cursor.fetchall()]
+
         tables = self.get_all_tables()
-        ret = []
-        for t in tables:
-            self.cursor.execute("SELECT COUNT(*) FROM {0}".format(t))
-            ret.append((t, int(self.cursor.fetchone()[0])))
-        return ret
+        if not tables:
+            return []
+        stmt = " UNION ALL ".join("SELECT %s::text, COUNT(*) FROM {0}".format(quote_ident(t, self.cursor).replace("%", "%%")) for t in tables)
+        self.cursor.execute(stmt, tables)
+        return [(t, int(n)) for t, n in self.cursor.fetchall()]
 
 
 